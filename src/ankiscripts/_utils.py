@@ -28,23 +28,31 @@ def add_exe_suffix(path: str) -> str:
     return path
 
 
-def pip_install(python_exe: str, reqs_filename: str, target: str | None = None) -> None:
+def pip_install(
+    python_exe: str,
+    reqs_filename: str,
+    target: str | None = None,
+    compile_bytecode: bool = True,
+) -> None:
     with open(reqs_filename, "r", encoding="utf-8") as file:
         if not file.read().strip():
             return
-    target_args = []
+    extra_args = []
     if target:
-        target_args.extend(["--target", target])
+        extra_args.extend(["--target", target])
+    if not compile_bytecode:
+        extra_args.append("--no-compile")
     subprocess.check_call(
         [
             python_exe,
             "-m",
             "pip",
             "install",
+            "--disable-pip-version-check",
             "--upgrade",
             "-r",
             reqs_filename,
-            *target_args,
+            *extra_args,
         ]
     )
 
@@ -9,8 +9,6 @@ from pathlib import Path
 from textwrap import dedent
 from typing import Any, Dict, List
 
-import jsonschema
-
 from ._utils import read_addon_json, run_bash_script
 
 
@@ -143,6 +141,8 @@ class Builder:
         schema_path = self.src_dir / "config.schema.json"
         if not instance_path.exists() or not schema_path.exists():
             return
+        import jsonschema
+
         instance = json.loads(instance_path.read_text(encoding="utf-8"))
         schema = json.loads(schema_path.read_text(encoding="utf-8"))
         jsonschema.validate(instance=instance, schema=schema)
@@ -268,8 +268,7 @@ class Builder:
                     rel_path.mkdir(parents=True, exist_ok=True)
                     shutil.copytree(path, rel_path, dirs_exist_ok=True)
                 else:
-                    with open(path, "r", encoding="utf-8") as srcfile:
-                        rel_path.write_text(srcfile.read(), encoding="utf-8")
+                    shutil.copyfile(path, rel_path)
 
     def _run_custom_build_script(self) -> None:
         # Additional build logic can be specified in scripts/build.sh
@@ -1,81 +1,311 @@
 from __future__ import annotations
 
 import argparse
+import functools
 import itertools
+import os
 import shutil
 import subprocess
 import sys
+import tempfile
+import threading
 import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Iterable
+from typing import Iterable, NamedTuple
+
+from packaging.utils import (
+    InvalidWheelFilename,
+    NormalizedName,
+    canonicalize_name,
+    parse_wheel_filename,
+)
+from packaging.version import InvalidVersion, Version
 
 from ._utils import pip_install, read_addon_json, run_bash_script
 
-LIB_EXT_GLOBS = ("*.so", "*.pyd", "*.dylib")
+LIB_EXT_SUFFIXES = (".so", ".pyd", ".dylib")
+# Native libraries are usually large, so they are copied in bigger chunks than the 64 KiB default
+COPY_BUFSIZE = 1 << 20
 
 addon_root = Path.cwd()
 
+LEGACY_PLATFORMS = ("win_amd64", "manylinux2014_x86_64", "macosx_10_7_x86_64")
+# https://github.com/ankitects/anki/blob/740528eaf913ff4bb9d112d494a10e84fd01365a/build/configure/src/python.rs#L141
+PLATFORMS = (
+    "manylinux_2_28_x86_64",
+    "manylinux_2_31_aarch64",
+    # FIXME: the following two are conflicting
+    "macosx_10_13_x86_64",
+    # "macosx_11_0_arm64",
+    "win_amd64",
+)
+# Python versions not listed here use PLATFORMS
+DEFAULT_PLATFORMS = {
+    "36": LEGACY_PLATFORMS,
+    "37": LEGACY_PLATFORMS,
+    "38": LEGACY_PLATFORMS,
+}
+
+# Wheels are immutable for a given package version and platform, so downloads are kept across runs (and add-ons)
+WHEEL_CACHE_DIR = (
+    Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache")
+    / "ankiscripts"
+    / "wheels"
+)
 
-def default_python_versions() -> Iterable[str]:
+
+@functools.lru_cache(maxsize=1)
+def default_python_versions() -> tuple[str, ...]:
     addon_meta = read_addon_json(addon_root)
     min_point_version = int(addon_meta.get("min_point_version", 0))
     max_point_version = abs(int(addon_meta.get("max_point_version", 999)))
-    versions = []
-    if min_point_version < 17:
-        versions.append("36")
-    if min_point_version < 36:
-        versions.append("37")
-    if min_point_version < 50:
-        versions.append("38")
-    if max_point_version >= 50:
-        versions.append("39")
-
-    return versions
+    return tuple(
+        version
+        for version, supported in (
+            ("36", min_point_version < 17),
+            ("37", min_point_version < 36),
+            ("38", min_point_version < 50),
+            ("39", max_point_version >= 50),
+        )
+        if supported
+    )
 
 
 def default_platforms_for_python_version(version: str) -> tuple[str, ...]:
-    if int(version) <= 38:
-        return ("win_amd64", "manylinux2014_x86_64", "macosx_10_7_x86_64")
-    # https://github.com/ankitects/anki/blob/740528eaf913ff4bb9d112d494a10e84fd01365a/build/configure/src/python.rs#L141
-    return (
-        "manylinux_2_28_x86_64",
-        "manylinux_2_31_aarch64",
-        # FIXME: the following two are conflicting
-        "macosx_10_13_x86_64",
-        # "macosx_11_0_arm64",
-        "win_amd64",
-    )
+    return DEFAULT_PLATFORMS.get(version, PLATFORMS)
+
+
+class VendoredPackage(NamedTuple):
+    name: str
+    version: str
+    module: str
+
+
+def has_native_libs(module_dir: Path) -> bool:
+    for _, _, filenames in os.walk(module_dir):
+        if any(filename.endswith(LIB_EXT_SUFFIXES) for filename in filenames):
+            return True
+    return False
+
+
+def scan_native_packages(vendor_path: Path) -> list[VendoredPackage]:
+    packages = []
+    with os.scandir(vendor_path) as entries:
+        for entry in entries:
+            if not entry.name.endswith(".dist-info") or not entry.is_dir():
+                continue
+            package_name, version = entry.name[: -len(".dist-info")].split("-")[:2]
+            try:
+                with open(
+                    os.path.join(entry.path, "top_level.txt"), "r", encoding="utf-8"
+                ) as file:
+                    module = file.read().strip()
+            except Exception:
+                module = package_name
+            if not has_native_libs(vendor_path / module):
+                continue
+            try:
+                Version(version)
+            except InvalidVersion:
+                print(
+                    f"Skipping wheels for {package_name}: {version} is not a valid version, "
+                    "so only the libraries installed for this platform are vendored",
+                    file=sys.stderr,
+                )
+                continue
+            packages.append(VendoredPackage(package_name, version, module))
+    return packages
 
 
 def pip_download(
     python_exe: str,
-    package_name: str,
-    version: str,
+    requirements: list[str],
     python_version: str,
     platform: str,
     dest: str,
 ) -> None:
-    try:
-        subprocess.check_call(
-            [
-                python_exe,
-                "-m",
-                "pip",
-                "download",
-                "--only-binary=:all:",
-                f"{package_name}=={version}",
-                "--python-version",
-                python_version,
-                "--implementation",
-                "cp",
-                "--platform",
-                platform,
-                "-d",
-                dest,
+    # Requirements are passed in a file to stay clear of command line length limits on Windows
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        reqs_path = Path(tmp_dir) / "requirements.txt"
+        reqs_path.write_text("\n".join(requirements), encoding="utf-8")
+        try:
+            # Progress output is discarded and errors are only shown on failure, as concurrent downloads would interleave them
+            subprocess.run(
+                [
+                    python_exe,
+                    "-m",
+                    "pip",
+                    "download",
+                    "--disable-pip-version-check",
+                    "--only-binary=:all:",
+                    "--no-deps",
+                    "-r",
+                    str(reqs_path),
+                    "--python-version",
+                    python_version,
+                    "--implementation",
+                    "cp",
+                    "--platform",
+                    platform,
+                    "-d",
+                    dest,
+                ],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                text=True,
+                check=True,
+            )
+            return
+        except subprocess.CalledProcessError as exc:
+            print(exc.stderr, str(exc), sep="", file=sys.stderr)
+    # A single requirement without a wheel for the platform fails the whole batch,
+    # so retry them one by one to still get wheels for the rest
+    if len(requirements) > 1:
+        for requirement in requirements:
+            pip_download(python_exe, [requirement], python_version, platform, dest)
+
+
+def download_wheels(
+    python_exe: str,
+    packages: list[VendoredPackage],
+    python_version: str,
+    platform: str,
+    dest: Path,
+) -> None:
+    dest.mkdir(parents=True, exist_ok=True)
+    cached = index_wheels([dest])
+    requirements = [
+        f"{package.name}=={package.version}"
+        for package in packages
+        if (canonicalize_name(package.name), Version(package.version)) not in cached
+    ]
+    if requirements:
+        # pip does not write wheels atomically, so they are only moved into the cache once fully downloaded,
+        # to keep interrupted or concurrent runs from leaving truncated wheels there
+        with tempfile.TemporaryDirectory(prefix=".download-", dir=dest) as tmp_dir:
+            pip_download(python_exe, requirements, python_version, platform, tmp_dir)
+            for wheel_path in Path(tmp_dir).glob("*.whl"):
+                os.replace(wheel_path, dest / wheel_path.name)
+
+
+def index_wheels(
+    wheels_dirs: Iterable[Path],
+) -> dict[tuple[NormalizedName, Version], list[Path]]:
+    wheels: dict[tuple[NormalizedName, Version], list[Path]] = {}
+    for wheels_dir in wheels_dirs:
+        for wheel_path in sorted(wheels_dir.glob("*.whl")):
+            try:
+                package_name, version, _, _ = parse_wheel_filename(wheel_path.name)
+            except InvalidWheelFilename:
+                continue
+            wheels.setdefault((package_name, version), []).append(wheel_path)
+    return wheels
+
+
+def extract_wheel_libs(wheel_path: Path, module: str, module_dir: Path) -> None:
+    prefix = f"{module}/"
+    module_root = module_dir.resolve()
+    created_dirs: set[Path] = set()
+    with zipfile.ZipFile(wheel_path, "r") as file:
+        for info in file.infolist():
+            name = info.filename
+            if not name.startswith(prefix) or not name.endswith(LIB_EXT_SUFFIXES):
+                continue
+            parts = name[len(prefix) :].split("/")
+            # Skip absolute, parent-relative and (on Windows) drive or backslash paths, which could escape module_dir
+            if any(
+                not part or part == ".." or "\\" in part or ":" in part
+                for part in parts
+            ):
+                continue
+            dst = module_dir.joinpath(*parts)
+            if dst.parent not in created_dirs:
+                # Libraries are written straight into the installed package, whose directories may be symlinks
+                parent = dst.parent.resolve()
+                if parent != module_root and module_root not in parent.parents:
+                    continue
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                created_dirs.add(dst.parent)
+            # Libraries are written to a temporary file first and then moved into place atomically,
+            # so an interrupted run never leaves a truncated library behind
+            tmp_path = dst.with_name(f"{dst.name}.tmp")
+            with file.open(info) as src, open(tmp_path, "wb") as out:
+                shutil.copyfileobj(src, out, COPY_BUFSIZE)
+            os.replace(tmp_path, dst)
+
+
+def extract_module_libs(wheel_paths: list[Path], module: str, module_dir: Path) -> None:
+    # Libraries with the same name in several wheels (e.g. abi3 ones) are taken from the last wheel
+    for wheel_path in wheel_paths:
+        extract_wheel_libs(wheel_path, module, module_dir)
+
+
+def vendor_native_libs(
+    python_exe: str,
+    packages: list[VendoredPackage],
+    python_versions: tuple[str, ...],
+    platforms: tuple[str, ...],
+    vendor_path: Path,
+) -> None:
+    # Downloads are independent pip processes, so they all run concurrently in the background
+    # while wheels for the Python versions that are already fetched get extracted.
+    # Wheels are stored per requested platform, as the platform tag of a compatible wheel
+    # often differs from it (e.g. manylinux2014 wheels are used for manylinux_2_28).
+    with ThreadPoolExecutor(8) as downloader, ThreadPoolExecutor() as extractor:
+        downloads: dict[str, dict[Path, Future[None]]] = {}
+        for python_version in python_versions:
+            downloads[python_version] = {}
+            for platform in platforms:
+                wheels_dir = WHEEL_CACHE_DIR / f"cp{python_version}-{platform}"
+                downloads[python_version][wheels_dir] = downloader.submit(
+                    download_wheels,
+                    python_exe,
+                    packages,
+                    python_version,
+                    platform,
+                    wheels_dir,
+                )
+        extractions: list[Future[None]] = []
+        for python_version, pending in downloads.items():
+            # Failures other than pip's own (which are reported and retried) must not go unnoticed
+            for future in pending.values():
+                future.result()
+            wheels = index_wheels(pending)
+            module_wheels: dict[str, list[Path]] = {}
+            for package in packages:
+                module_wheels.setdefault(package.module, []).extend(
+                    wheels.get(
+                        (
+                            canonicalize_name(package.name),
+                            Version(package.version),
+                        ),
+                        (),
+                    )
+                )
+            # Modules are extracted in parallel, but each one's wheels are applied in
+            # (Python version, platform) order so that the same library always wins
+            for future in extractions:
+                future.result()
+            extractions = [
+                extractor.submit(
+                    extract_module_libs,
+                    wheel_paths,
+                    module,
+                    vendor_path / module,
+                )
+                for module, wheel_paths in module_wheels.items()
             ]
-        )
-    except subprocess.CalledProcessError as exc:
-        print(str(exc), file=sys.stderr)
+        for future in extractions:
+            future.result()
+
+
+def remove_tree(path: Path, errors: list[OSError]) -> None:
+    # Runs in a background thread, so failures are collected for the caller to report
+    try:
+        shutil.rmtree(path)
+    except OSError as exc:
+        errors.append(exc)
 
 
 def install_libs(
@@ -83,66 +313,56 @@ def install_libs(
 ) -> None:
     if not python_versions:
         python_versions = default_python_versions()
+    # Both are iterated once per Python version below, so they must not be one-shot iterators.
+    # Duplicates are dropped as they would download to the same directory concurrently.
+    python_versions = tuple(dict.fromkeys(python_versions))
     if not platforms:
-        platforms = itertools.chain(
-            *(
-                default_platforms_for_python_version(version)
-                for version in python_versions
-            )
+        platforms = itertools.chain.from_iterable(
+            default_platforms_for_python_version(version) for version in python_versions
         )
+    platforms = tuple(dict.fromkeys(platforms))
 
     addon_root = Path(".")
     reqs_path = addon_root / "requirements" / "bundle.txt"
     if reqs_path.exists():
         vendor_path = addon_root / "src" / "vendor"
-        vendor_path.mkdir(exist_ok=True)
-        shutil.rmtree(vendor_path)
-        bin_path = vendor_path / "bin"
-        python_exe = shutil.which("python")
-        pip_install(python_exe, str(reqs_path), str(vendor_path))
-        if bin_path.exists():
-            shutil.rmtree(bin_path)
-
-        # Handle dependencies with C modules by downloading wheels for all supported platforms and copying C libraries from them
-        build_dir = addon_root / "build"
-        build_dir.mkdir(exist_ok=True)
-        for dist_info_dir in vendor_path.iterdir():
-            if not dist_info_dir.is_dir() or not dist_info_dir.match("*.dist-info"):
-                continue
-            package_name = dist_info_dir.name.split("-")[0]
-            try:
-                with open(
-                    dist_info_dir / "top_level.txt", "r", encoding="utf-8"
-                ) as file:
-                    module = file.read().strip()
-            except Exception:
-                module = package_name
-            module_dir = vendor_path / module
-            if not any(list(module_dir.rglob(g)) for g in LIB_EXT_GLOBS):
-                continue
-            version = dist_info_dir.name.split("-")[1].rsplit(".", maxsplit=1)[0]
-            for python_version in python_versions:
-                for platform in platforms:
-                    pip_download(
-                        python_exe,
-                        package_name,
-                        version,
-                        python_version,
-                        platform,
-                        str(build_dir),
+        remover: threading.Thread | None = None
+        removal_errors: list[OSError] = []
+        if vendor_path.exists():
+            # Move the old tree out of the way and delete it in the background while pip installs the new one
+            old_vendor_path = Path(tempfile.mkdtemp(prefix=".vendor-", dir=addon_root))
+            vendor_path.rename(old_vendor_path / "vendor")
+            remover = threading.Thread(
+                target=remove_tree, args=(old_vendor_path, removal_errors)
+            )
+            remover.start()
+        try:
+            vendor_path.mkdir()
+            bin_path = vendor_path / "bin"
+            python_exe = shutil.which("python") or sys.executable
+            # Bytecode is not shipped with add-ons (see build.py), so there is no need to compile it
+            pip_install(
+                python_exe, str(reqs_path), str(vendor_path), compile_bytecode=False
+            )
+            if bin_path.exists():
+                shutil.rmtree(bin_path)
+
+            # Handle dependencies with C modules by downloading wheels for all supported platforms and copying C libraries from them
+            packages = scan_native_packages(vendor_path)
+            if packages:
+                vendor_native_libs(
+                    python_exe, packages, python_versions, platforms, vendor_path
+                )
+        finally:
+            if remover:
+                remover.join()
+                if removal_errors:
+                    print(
+                        f"Failed to delete the previous vendor directory {old_vendor_path}:",
+                        *removal_errors,
+                        sep="\n",
+                        file=sys.stderr,
                     )
-                for wheel_path in build_dir.glob(
-                    f"{package_name}-{version}-cp{python_version}-*.whl"
-                ):
-                    wheel_dir = build_dir / wheel_path.stem
-                    wheel_dir.mkdir(exist_ok=True)
-                    with zipfile.ZipFile(wheel_path, "r") as file:
-                        file.extractall(wheel_dir)
-                    for p in (wheel_dir / module).rglob("*"):
-                        if any(p.match(g) for g in LIB_EXT_GLOBS):
-                            dst = module_dir / p.relative_to(wheel_dir / module)
-                            dst.parent.mkdir(parents=True, exist_ok=True)
-                            shutil.copy(p, dst)
 
     # Additional vendoring logic (e.g. installing node modules) can be specified in scripts/vendor.sh
     vendor_script_path = addon_root / "scripts" / "vendor.sh"